@@ -1,111 +1,178 @@
-import json
-import collections
-from datetime import datetime
+import io
 import math
 import argparse
 import os
 
+import ijson
+import numpy as np
+import orjson
+
+def iter_price_rows(input_file):
+    # Построчное чтение append-only формата jsonl из main.py; старый
+    # формат (цельный json-массив) разбирается потоково через ijson
+    with open(input_file, 'rb') as f:
+        if input_file.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+        else:
+            yield from ijson.items(f, 'item')
+
 def calculate_price_changes(input_file, output_file):
-    # Загрузка исторических данных
-    with open(input_file, 'r') as f:
-        data = json.load(f)
-    
-    print(f"Загружено {len(data)} записей")
-    
-    # Сортировка по времени на всякий случай
-    data.sort(key=lambda x: x[0])
-    
-    # Вычисление процентных изменений
-    results = []
-    total = len(data) - 1
-    
-    for i in range(1, len(data)):
-        # Периодический вывод прогресса
-        if i % 100000 == 0:
-            dt = datetime.fromtimestamp(data[i][0]/1000)
-            print(f"Обработано {i}/{total} записей ({i/total:.1%}) | Текущая дата: {dt.strftime('%Y-%m-%d %H:%M')}")
-        
-        timestamp = data[i][0]
-        price1 = float(data[i-1][1])
-        price2 = float(data[i][1])
-        
-        # Расчет процентного изменения
-        change = (price2 - price1) / price1 * 100
-        rounded_change = round(change, 10)  # Округление до 10 знаков
-        
-        results.append([timestamp, rounded_change])
-    
-    # Сохранение результатов
-    with open(output_file, 'w') as f:
-        json.dump(results, f)
-    
+    if input_file.endswith('.parquet'):
+        # Колоночный формат читается сразу в массивы NumPy
+        import pyarrow.parquet as pq
+        table = pq.read_table(input_file)
+        ts = table.column('ts').to_numpy()
+        prices = table.column('close').to_numpy()
+        count = len(ts)
+    else:
+        # Потоковое чтение исторических данных: записи складываются сразу в
+        # типизированные массивы, без промежуточного списка из миллионов
+        # мелких списков [ts, price] (пик памяти ~6x размера файла)
+        estimate = max(os.path.getsize(input_file) // 25, 1024)
+        ts = np.empty(estimate, dtype=np.int64)
+        prices = np.empty(estimate, dtype=np.float64)
+
+        count = 0
+        for row in iter_price_rows(input_file):
+            if count == len(ts):
+                # Оценка по размеру файла оказалась мала — растим буферы блоками по 1М строк
+                ts = np.resize(ts, len(ts) + 1_000_000)
+                prices = np.resize(prices, len(prices) + 1_000_000)
+            ts[count] = row[0]
+            prices[count] = float(row[1])
+            count += 1
+
+        ts = ts[:count]
+        prices = prices[:count]
+    print(f"Загружено {count} записей")
+
+    # Пустой или одиночный файл — легитимный артефакт прерванной в самом
+    # начале загрузки; изменения по нему посчитать нельзя
+    if count < 2:
+        print("Недостаточно данных для расчета изменений (нужно минимум 2 записи)")
+        return None
+
+    # Binance отдает свечи в хронологическом порядке, поэтому сортируем
+    # только если монотонность действительно нарушена
+    if not np.all(np.diff(ts) >= 0):
+        order = np.argsort(ts, kind='stable')
+        ts = ts[order]
+        prices = prices[order]
+
+    # Расчет процентного изменения с округлением до 10 знаков;
+    # результат пишется сразу в один заранее выделенный буфер (n, 2),
+    # а цепочка ufunc выполняется in-place прямо в колонке результата —
+    # без четырех промежуточных массивов на миллионы элементов
+    n = count - 1
+    results = np.empty((n, 2), dtype=np.float64)
+    results[:, 0] = ts[1:]
+    changes = results[:, 1]
+    np.subtract(prices[1:], prices[:-1], out=changes)
+    changes /= prices[:-1]
+    changes *= 100
+    np.round(changes, 10, out=changes)
+    print(f"Вычислено {n} изменений")
+
+    # Сохранение результатов в бинарном виде: 8 байт на число вместо
+    # ~20 байт десятичного текста, и чтение без парсинга цифр
+    np.save(output_file, results)
+
     print(f"\nПроцентные изменения сохранены в {output_file}")
     return results
 
 def frequency_analysis(changes_data, symbol, interval):
     symbol_lower = symbol.lower()
-    
+
     # Извлекаем только значения изменений
-    changes = [item[1] for item in changes_data]
-    
-    # Считаем частоту
-    counter = collections.Counter(changes)
-    
-    # Сортируем по частоте
-    sorted_freq = counter.most_common()
-    
-    # Сохраняем полный анализ в файл
-    with open(f'frequency_analysis_full_{symbol_lower}_{interval}.json', 'w') as f:
-        json.dump(sorted_freq, f)
-    
-    # Находим экстремальные значения
-    sorted_by_value = sorted(changes_data, key=lambda x: x[1])
-    top_negative = sorted_by_value[:10]  # Самые большие отрицательные изменения
-    top_positive = sorted_by_value[-10:][::-1]  # Самые большие положительные изменения
-    
-    # Подготовка данных для вывода
+    changes = changes_data[:, 1]
+
+    # Квантуем изменения (округлены до 10 знаков) в целые «тики» по 1e-10:
+    # int64-ключи считаются и хэшируются быстрее float64 и короче в json
+    ticks = np.rint(changes * 1e10).astype(np.int64)
+
+    # Считаем частоту одним C-проходом вместо Counter
+    # по миллионам упакованных float-объектов
+    values, counts = np.unique(ticks, return_counts=True)
+
+    # Сохраняем полный анализ в бинарный .npy в естественном порядке
+    # np.unique (по значению) — полная сортировка всех уникальных
+    # значений по частоте ради двух топ-50 не нужна
+    np.save(f'frequency_analysis_full_{symbol_lower}_{interval}.npy',
+            np.column_stack([values, counts]))
+
+    # Топ-50 частых и топ-50 редких: частичный отбор за O(U) вместо
+    # полной сортировки всех U уникальных значений
+    m = min(50, counts.size)
+    idx_top = np.argpartition(-counts, m - 1)[:m]
+    idx_top = idx_top[np.argsort(-counts[idx_top], kind='stable')]
+    idx_rare = np.argpartition(counts, m - 1)[:m]
+    idx_rare = idx_rare[np.argsort(-counts[idx_rare], kind='stable')]
+    # Обратно в проценты только для 100 печатаемых строк
+    top_freq = list(zip((values[idx_top] / 1e10).tolist(), counts[idx_top].tolist()))
+    rare_freq = list(zip((values[idx_rare] / 1e10).tolist(), counts[idx_rare].tolist()))
+    
+    # Находим экстремальные значения: частичный отбор за O(n) вместо
+    # полной сортировки всего массива ради 20 строк
+    k = min(10, changes.size)
+    idx_neg = np.argpartition(changes, k - 1)[:k]
+    idx_neg = idx_neg[np.argsort(changes[idx_neg])]
+    idx_pos = np.argpartition(changes, changes.size - k)[-k:]
+    idx_pos = idx_pos[np.argsort(changes[idx_pos])][::-1]
+    top_negative = changes_data[idx_neg].tolist()  # Самые большие отрицательные изменения
+    top_positive = changes_data[idx_pos].tolist()  # Самые большие положительные изменения
+
+    # Метки времени экстремумов форматируются одним векторным вызовом (UTC)
+    labels_neg = np.datetime_as_string(changes_data[idx_neg, 0].astype(np.int64).astype('datetime64[ms]'), unit='m')
+    labels_pos = np.datetime_as_string(changes_data[idx_pos, 0].astype(np.int64).astype('datetime64[ms]'), unit='m')
+    labels_neg = np.char.replace(labels_neg, 'T', ' ')
+    labels_pos = np.char.replace(labels_pos, 'T', ' ')
+    
+    # Подготовка данных для вывода: отчет собирается в один буфер,
+    # без промежуточного списка строк и повторного join
     total = len(changes)
-    report = []
-    
+    sio = io.StringIO()
+
     # Формируем заголовок
-    report.append(f"Анализ для {symbol} (интервал: {interval})")
-    report.append(f"{'Процентное изменение':^25} | {'Количество':^12}")
-    report.append("-" * 40)
-    
+    sio.write(f"Анализ для {symbol} (интервал: {interval})\n")
+    sio.write(f"{'Процентное изменение':^25} | {'Количество':^12}\n")
+    sio.write("-" * 40 + "\n")
+
     # Топ-50 самых частых
-    report.append("\nСамые частые изменения (топ-50):")
-    for value, count in sorted_freq[:50]:
-        report.append(f"{value:>24.10f}% | {count:>11,}")
-    
+    sio.write("\nСамые частые изменения (топ-50):\n")
+    for value, count in top_freq:
+        sio.write(f"{value:>24.10f}% | {count:>11,}\n")
+
     # Топ-50 самых редких
-    report.append("\nСамые редкие изменения (топ-50):")
-    for value, count in sorted_freq[-50:]:
-        report.append(f"{value:>24.10f}% | {count:>11,}")
-    
+    sio.write("\nСамые редкие изменения (топ-50):\n")
+    for value, count in rare_freq:
+        sio.write(f"{value:>24.10f}% | {count:>11,}\n")
+
     # Самые большие изменения
-    report.append("\nСамые большие положительные изменения:")
-    for item in top_positive:
-        dt = datetime.fromtimestamp(item[0]/1000).strftime('%Y-%m-%d %H:%M')
-        report.append(f"{dt} | {item[1]:>24.10f}%")
-    
-    report.append("\nСамые большие отрицательные изменения:")
-    for item in top_negative:
-        dt = datetime.fromtimestamp(item[0]/1000).strftime('%Y-%m-%d %H:%M')
-        report.append(f"{dt} | {item[1]:>24.10f}%")
-    
+    sio.write("\nСамые большие положительные изменения:\n")
+    for label, item in zip(labels_pos, top_positive):
+        sio.write(f"{label} | {item[1]:>24.10f}%\n")
+
+    sio.write("\nСамые большие отрицательные изменения:\n")
+    for label, item in zip(labels_neg, top_negative):
+        sio.write(f"{label} | {item[1]:>24.10f}%\n")
+
     # Статистика
-    report.append("\nОбщая статистика:")
-    report.append(f"Всего изменений: {total:,}")
-    report.append(f"Уникальных значений: {len(sorted_freq):,}")
-    
+    sio.write("\nОбщая статистика:\n")
+    sio.write(f"Всего изменений: {total:,}\n")
+    sio.write(f"Уникальных значений: {values.size:,}\n")
+
     # Сохранение отчета
+    report = sio.getvalue()
     report_filename = f'frequency_analysis_report_{symbol_lower}_{interval}.txt'
     with open(report_filename, 'w') as f:
-        f.write("\n".join(report))
-    
-    # Вывод сокращенной версии в консоль
-    print("\n".join(report[:55] + ["...", f"Полный отчет сохранен в {report_filename}"]))
-    return sorted_freq
+        f.write(report)
+
+    # Вывод сокращенной версии в консоль (первые 55 строк)
+    head = "\n".join(report.split("\n", 55)[:55])
+    print("\n".join([head, "...", f"Полный отчет сохранен в {report_filename}"]))
+    return values, counts
 
 def main():
     parser = argparse.ArgumentParser(description='Analyze cryptocurrency price changes')
@@ -120,18 +187,20 @@ def main():
     symbol_lower = symbol.lower()
     interval = args.interval
     
-    input_file = f"{symbol_lower}_{interval}_prices.json"
-    
-    # Проверяем существование файла
-    if not os.path.exists(input_file):
-        print(f"Ошибка: файл {input_file} не найден.")
+    # Ищем данные в любом из форматов main.py (старые загрузки — в .json)
+    candidates = [f"{symbol_lower}_{interval}_prices.{ext}" for ext in ('jsonl', 'parquet', 'json')]
+    input_file = next((name for name in candidates if os.path.exists(name)), None)
+    if input_file is None:
+        print(f"Ошибка: файл {candidates[0]} не найден.")
         print(f"Сначала скачайте данные для пары {symbol} с интервалом {interval} с помощью main.py")
         return
     
-    changes_file = f"price_changes_{symbol_lower}_{interval}.json"
+    changes_file = f"price_changes_{symbol_lower}_{interval}.npy"
     
     # Шаг 1: Расчет процентных изменений
     changes_data = calculate_price_changes(input_file, changes_file)
+    if changes_data is None:
+        return
     
     # Шаг 2: Частотный анализ
     frequency_analysis(changes_data, symbol, interval)
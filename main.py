@@ -1,22 +1,50 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import diskcache
+import numpy as np
 import time
-import json
+import threading
+import orjson
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import argparse
 import os
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("data_download.log"),
-        logging.StreamHandler()
-    ]
-)
+# Настройка логирования: записи попадают в очередь, а блокирующие
+# write-сисколлы в файл и консоль выполняет фоновый поток слушателя —
+# горячий цикл загрузки не ждет диска
+_log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+_log_handlers = [logging.FileHandler("data_download.log"), logging.StreamHandler()]
+for _h in _log_handlers:
+    _h.setFormatter(_log_formatter)
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *_log_handlers)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+# QueueHandler подставляет аргументы заранее, но не должен добавлять
+# свой префикс — итоговый формат накладывают обработчики слушателя
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
 logger = logging.getLogger()
 
+# Общая HTTP-сессия: keep-alive и пул соединений вместо нового TCP/TLS
+# рукопожатия на каждый запрос, gzip сокращает объем трафика.
+# Повторы с экспоненциальным backoff выполняются внутри пула urllib3,
+# Retry-After от Binance при 429 учитывается автоматически
+RETRY_POLICY = Retry(total=5, backoff_factor=0.2,
+                     status_forcelist=[429, 500, 502, 503, 504],
+                     respect_retry_after_header=True, allowed_methods=['GET'])
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=RETRY_POLICY))
+SESSION.headers.update({'Accept-Encoding': 'gzip', 'User-Agent': 'get-all-prices/0.1'})
+
 # Словарь для перевода интервала в миллисекунды
 INTERVAL_TO_MS = {
     '1m': 60 * 1000,
@@ -36,6 +64,52 @@ INTERVAL_TO_MS = {
     '1M': 30 * 24 * 60 * 60 * 1000  # Приблизительно
 }
 
+class RateLimiter:
+    """Shared token-bucket limiter for all download threads.
+
+    Бюджет задается в request weight Binance за минуту: токены копятся
+    с постоянной скоростью до небольшого запаса, поэтому поток спит
+    ровно столько, сколько не хватает до нужного веса, а не фиксированный
+    интервал между запросами.
+    """
+    def __init__(self, weight_per_minute, burst=20):
+        self.rate = weight_per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.lock = threading.Lock()
+        self.updated = time.monotonic()
+
+    def wait(self, weight=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    return
+                delay = (weight - self.tokens) / self.rate
+            time.sleep(delay)
+
+# Параллельная загрузка: окна запросов не пересекаются и независимы,
+# поэтому выполняются пулом потоков; общий ограничитель частоты
+# удерживает суммарный темп в рамках лимитов Binance (6000 weight/мин,
+# оставляем большой запас)
+MAX_WORKERS = 8
+RATE_LIMITER = RateLimiter(1500)
+KLINES_WEIGHT = 2  # вес запроса /api/v3/klines
+
+# Дисковый кэш скачанных окон: закрытые свечи неизменяемы, поэтому при
+# повторном запуске попадание в кэш всегда валидно и запрос не нужен
+_klines_caches = {}
+_klines_caches_lock = threading.Lock()
+
+def get_klines_cache(symbol):
+    with _klines_caches_lock:
+        if symbol not in _klines_caches:
+            _klines_caches[symbol] = diskcache.Cache(f".klines_cache/{symbol}")
+        return _klines_caches[symbol]
+
 def date_to_milliseconds(date_str):
     """Convert UTC date string to milliseconds since epoch."""
     try:
@@ -45,117 +119,206 @@ def date_to_milliseconds(date_str):
         logger.error(f"Date conversion error: {str(e)}")
         raise
 
-def get_first_trading_date(symbol, interval='1m', max_retries=3):
+def get_first_trading_date(symbol, interval='1m', session=SESSION):
     """
     Получает реальную дату начала торгов для символа через API Binance.
-    Запрашивает данные с очень ранней даты и использует первую полученную свечу.
+    Бинарный поиск по дневным свечам: ~13 дешевых запросов с limit=1
+    вместо одного тяжелого сканирования всей истории с 2010 года.
     """
     logger.info(f"Getting first trading date for {symbol} with interval {interval}")
     
-    # Используем очень раннюю дату (до создания Binance)
-    early_start = date_to_milliseconds("2010-01-01 00:00:00")
-    end_time = int(time.time() * 1000)
-    
     url = "https://api.binance.com/api/v3/klines"
-    params = {
-        'symbol': symbol,
-        'interval': interval,
-        'startTime': early_start,
-        'endTime': end_time,
-        'limit': 1  # Запрашиваем только первую свечу
-    }
+    now_ms = int(time.time() * 1000)
+    day_ms = INTERVAL_TO_MS['1d']
     
-    for attempt in range(max_retries):
-        try:
-            logger.debug(f"Attempt {attempt+1}: Requesting first candle for {symbol}")
-            response = requests.get(url, params=params)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data:
-                    first_timestamp = data[0][0]  # Время открытия первой свечи
-                    first_date = datetime.fromtimestamp(first_timestamp/1000)
-                    logger.info(f"First trading date for {symbol} ({interval}): {first_date}")
-                    return first_timestamp
-                else:
-                    logger.warning(f"No data returned for {symbol}")
-                    return None
-            elif response.status_code == 429:
-                logger.warning(f"Rate limit exceeded! Retrying in {2**attempt}s")
-                time.sleep(2 ** attempt)
+    def first_daily_candle(start_ms):
+        # Время открытия первой дневной свечи не раньше start_ms;
+        # повторы и backoff выполняет Retry-политика сессии, а
+        # исчерпание попыток пробрасывается исключением наверх: сбой
+        # запроса — не то же самое, что «в этой точке торгов не было»
+        params = {
+            'symbol': symbol,
+            'interval': '1d',
+            'startTime': start_ms,
+            'endTime': now_ms,
+            'limit': 1
+        }
+        response = session.get(url, params=params, timeout=10)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        return data[0][0] if data else None
+    
+    # Сужаем границу "торги уже идут" делением диапазона пополам,
+    # начиная с очень ранней даты (до создания Binance). Сбой любой
+    # пробы прерывает поиск целиком: иначе он сошелся бы к слишком
+    # поздней дате и начало истории молча потерялось бы
+    try:
+        lo = date_to_milliseconds("2010-01-01 00:00:00")
+        hi = now_ms
+        while hi - lo >= day_ms:
+            mid = (lo + hi) // 2
+            first_open = first_daily_candle(mid)
+            if first_open is not None and first_open - mid < day_ms:
+                hi = mid  # в точке mid торги уже шли — ищем раньше
             else:
-                logger.error(f"API error {response.status_code}: {response.text}")
-                return None
-                
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}")
+                lo = mid  # торгов в mid еще не было
         
-        if attempt < max_retries - 1:
-            time.sleep(1)
+        first_timestamp = first_daily_candle(lo)
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Request failed during first-date search: {str(e)}")
+        return None
+    if first_timestamp is not None:
+        first_date = datetime.fromtimestamp(first_timestamp/1000)
+        logger.info(f"First trading date for {symbol} ({interval}): {first_date}")
+        return first_timestamp
     
     logger.error(f"Failed to get first trading date for {symbol}")
     return None
 
-def fetch_klines(start_time, end_time, symbol, interval='1m', max_retries=5, delay=0.2):
+def fetch_klines(start_time, end_time, symbol, interval='1m', session=SESSION):
     """Fetch klines from Binance API with retries."""
-    url = "https://api.binance.com/api/v3/klines"
-    params = {
-        'symbol': symbol,
-        'interval': interval,
-        'startTime': start_time,
-        'endTime': end_time,
-        'limit': 1000
-    }
+    # Окно целиком в прошлом? Тогда его можно взять из кэша или положить
+    # туда после загрузки. Запас — полный интервал: последняя свеча окна
+    # закрывается через interval после своего открытия, и кэшировать ее
+    # ещё формирующуюся цену закрытия нельзя
+    cache = get_klines_cache(symbol)
+    cache_key = (interval, start_time, end_time)
+    window_closed = end_time < int(time.time() * 1000) - INTERVAL_TO_MS[interval]
+    if window_closed and cache_key in cache:
+        logger.debug("Cache hit: %s to %s", start_time, end_time)
+        return cache[cache_key]
     
-    for attempt in range(max_retries):
-        try:
-            logger.debug(f"Request attempt {attempt+1}: {params}")
-            response = requests.get(url, params=params)
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data:
-                    logger.info(f"Successful request: {start_time} to {end_time}")
-                    logger.debug(f"Received {len(data)} records")
-                    return data
-                else:
-                    logger.debug("No data in response")
-                    return []
-            elif response.status_code == 429:
-                logger.warning(f"Rate limit exceeded! Retrying in {delay*(2**attempt)}s")
-                time.sleep(delay * (2 ** attempt))
-            else:
-                logger.error(f"API error {response.status_code}: {response.text}")
-                logger.error(f"Request params: {params}")
-                if response.status_code >= 500:
-                    logger.info("Server error, retrying...")
-                    time.sleep(delay * (2 ** attempt))
-                else:
-                    return None
-                    
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error: {str(e)}")
-        except Exception as e:
-            logger.error(f"Unexpected error: {str(e)}")
-        
-        if attempt < max_retries - 1:
-            sleep_time = delay * (2 ** attempt)
-            logger.info(f"Retrying in {sleep_time:.1f}s...")
-            time.sleep(sleep_time)
+    # Строка запроса собирается один раз: requests не пересобирает
+    # словарь параметров и не кодирует URL заново при каждой попытке.
+    # limit=1000 — документированный максимум klines: одно окно 1m
+    # покрывает ~16.6 часов, поэтому более грубый --interval (5m, 1h...)
+    # сокращает число запросов на бэкфилл в 5-60 раз
+    url = ("https://api.binance.com/api/v3/klines"
+           f"?symbol={symbol}&interval={interval}"
+           f"&startTime={start_time}&endTime={end_time}&limit=1000")
     
-    logger.error(f"Max retries exceeded for request: {params}")
-    return None
+    RATE_LIMITER.wait(KLINES_WEIGHT)
+    logger.debug("Request: %s", url)
+    try:
+        response = session.get(url, timeout=10)
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        # Retry-политика сессии уже исчерпала 5 попыток с backoff
+        logger.error(f"Request failed after retries: {url} ({str(e)})")
+        return None
+    
+    data = orjson.loads(response.content)
+    if window_closed:
+        cache[cache_key] = data
+    if data:
+        # Уровень DEBUG: сообщение на каждый успешный запрос
+        # заспамило бы консоль и лог при параллельной загрузке
+        logger.debug("Successful request: %s to %s", start_time, end_time)
+        logger.debug("Received %d records", len(data))
+    else:
+        logger.debug("No data in response")
+    return data
 
-def save_progress(data, filename):
-    """Save download progress to file"""
+def read_last_timestamp(path):
+    """Метка времени последней записи jsonl-файла (None, если файла нет)."""
     try:
-        with open(filename, 'w') as f:
-            json.dump(data, f)
-        logger.info(f"Progress saved: {len(data)} records")
-    except Exception as e:
-        logger.error(f"Failed to save progress: {str(e)}")
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return None
+            # Читаем только хвост файла: последняя строка гарантированно
+            # короче 2 КБ, сканировать гигабайты истории не нужно
+            f.seek(-min(size, 2048), os.SEEK_END)
+            lines = f.read().strip().splitlines()
+    except FileNotFoundError:
+        return None
+    # Прерванный на середине записи запуск (OOM, потеря питания до
+    # сброса буфера) оставляет оборванную последнюю строку — в этом
+    # случае откатываемся к последней целой записи в хвосте
+    for line in reversed(lines):
+        try:
+            return orjson.loads(line)[0]
+        except orjson.JSONDecodeError:
+            continue
+    return None
+
+class JsonlWriter:
+    """Append-only writer: one JSON row per line."""
+    def __init__(self, path):
+        self.f = open(path, 'ab', buffering=1 << 20)
+
+    def write_batch(self, times, closes):
+        # tolist() отдает обычные int/float — orjson сериализует их
+        # напрямую, без обращений к скалярам NumPy
+        for row in zip(times.tolist(), closes.tolist()):
+            self.f.write(orjson.dumps(row) + b'\n')
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+class ParquetBatchWriter:
+    """Columnar writer: batches are buffered and flushed as row groups."""
+    def __init__(self, path):
+        # pyarrow импортируется лениво: он тяжелый и нужен только
+        # при --format parquet
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([('ts', pa.int64()), ('close', pa.float64())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.pending = []
+        self.pending_rows = 0
+
+    def write_batch(self, times, closes):
+        self.pending.append((times, closes))
+        self.pending_rows += len(times)
+        # Row group примерно на 50 запросов, чтобы файл не дробился
+        if self.pending_rows >= 50_000:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            table = self.pa.table(
+                {'ts': np.concatenate([ts for ts, _ in self.pending]),
+                 'close': np.concatenate([px for _, px in self.pending])},
+                schema=self.schema)
+            self.writer.write_table(table)
+            self.pending = []
+            self.pending_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def writer_loop(write_queue, fout, failure):
+    """Фоновая запись: снимает пачки с очереди и дописывает их в файл.
+
+    Ошибка записи (кончилось место, сломался parquet-поток) кладется в
+    failure и логируется, после чего очередь продолжает опустошаться
+    вхолостую — иначе продюсер навсегда завис бы на put() в заполненную
+    очередь, а завершение — на put(None).
+    """
+    batches_written = 0
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        try:
+            times, closes = item
+            fout.write_batch(times, closes)
+            batches_written += 1
+            if batches_written % 50 == 0:
+                fout.flush()
+        except Exception as e:
+            failure.append(e)
+            logger.exception("Writer thread failed:")
+            while write_queue.get() is not None:
+                pass
+            return
 
 def main():
     parser = argparse.ArgumentParser(description='Download cryptocurrency data from Binance')
@@ -166,13 +329,24 @@ def main():
     parser.add_argument('--interval', type=str, default='1m', 
                         choices=['1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '8h', '12h', '1d', '3d', '1w', '1M'],
                         help='Time interval for candles (default: 1m)')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help=f'Number of concurrent download threads (default: {MAX_WORKERS})')
+    parser.add_argument('--format', type=str, default='jsonl', choices=['jsonl', 'parquet'],
+                        help='Output file format (default: jsonl)')
     args = parser.parse_args()
     
+    if args.workers > 16:
+        # Пул соединений должен вмещать все потоки загрузки, иначе
+        # requests будет открывать соединения сверх пула и сразу
+        # выбрасывать их, теряя выгоду keep-alive
+        SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=args.workers,
+                                              max_retries=RETRY_POLICY))
+    
     symbol = args.symbol
     symbol_lower = symbol.lower()
     start_date = args.start_date
     interval = args.interval
-    output_file = f"{symbol_lower}_{interval}_prices.json"
+    output_file = f"{symbol_lower}_{interval}_prices.{args.format}"
     
     logger.info(f"Starting {symbol} {interval} data download")
     
@@ -187,28 +361,70 @@ def main():
         current_start = date_to_milliseconds(start_date)
         logger.warning(f"Could not determine first trading date. Using specified date: {datetime.fromtimestamp(current_start/1000)}")
     
+    # Возобновление прерванной загрузки: jsonl дополняется, поэтому
+    # достаточно продолжить со свечи, следующей за последней записанной,
+    # вместо повторного скачивания всей истории
+    interval_ms = INTERVAL_TO_MS[interval]
+    if args.format == 'jsonl':
+        checkpoint_ts = read_last_timestamp(output_file)
+        if checkpoint_ts is not None:
+            current_start = max(current_start, checkpoint_ts + interval_ms)
+            logger.info(f"Resuming from checkpoint: {datetime.fromtimestamp(current_start/1000)}")
+    elif os.path.exists(output_file):
+        logger.warning(f"{output_file} already exists and will be overwritten (parquet cannot be appended)")
+    
     end_time = int(time.time() * 1000)
     
-    all_data = []
+    # Заранее рассчитываем все окна запросов (по 1000 свечей каждое):
+    # они не пересекаются, поэтому их можно скачивать параллельно;
+    # границы считаются двумя векторными операциями вместо цикла
+    window_ms = 1000 * interval_ms
+    starts = np.arange(current_start, end_time, window_ms, dtype=np.int64)
+    ends = np.minimum(starts + window_ms - 1, end_time)
+    windows = list(zip(starts.tolist(), ends.tolist()))
+    
+    logger.info(f"Scheduled {len(windows)} request windows")
+    
+    # Данные не накапливаются в памяти — они уже в jsonl-файле;
+    # для логов прогресса достаточно счетчиков
+    total_records = 0
+    first_ts = None
+    last_ts = None
     request_count = 0
     last_successful_timestamp = current_start
     empty_intervals = 0
     max_empty_intervals = 100
     
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+    # Чекпоинты append-only: каждая пачка уходит в файл сразу, вместо
+    # пересериализации всего списка каждые 50 запросов; parquet хранит
+    # колонки ts/close бинарно и занимает в разы меньше места
+    if args.format == 'parquet':
+        fout = ParquetBatchWriter(output_file)
+    else:
+        fout = JsonlWriter(output_file)
+    # Запись на диск идет в отдельном потоке через ограниченную очередь:
+    # сеть и диск работают параллельно, а maxsize дает обратное давление,
+    # если диск перестает успевать за загрузкой
+    write_queue = queue.Queue(maxsize=128)
+    writer_failure = []
+    writer = threading.Thread(target=writer_loop, args=(write_queue, fout, writer_failure),
+                              daemon=True)
+    writer.start()
     try:
-        while current_start < end_time:
-            # Вычисляем конечное время для запроса (1000 свечей)
-            interval_ms = INTERVAL_TO_MS[interval]
-            current_end = current_start + (1000 * interval_ms) - 1
-            
-            logger.debug(f"Fetching {datetime.fromtimestamp(current_start/1000)} to {datetime.fromtimestamp(min(current_end, end_time)/1000)}")
-            klines = fetch_klines(current_start, min(current_end, end_time), symbol, interval)
+        # Окна уходят в пул потоков, а результаты разбираются в исходном
+        # порядке: сетевые задержки перекрываются, порядок данных сохраняется
+        futures = [pool.submit(fetch_klines, w_start, w_end, symbol, interval)
+                   for w_start, w_end in windows]
+        
+        for (w_start, w_end), future in zip(windows, futures):
+            klines = future.result()
             
-            if klines is None:
-                logger.error(f"Failed to get data for range: {current_start}-{current_end}")
+            while klines is None:
+                logger.error(f"Failed to get data for range: {w_start}-{w_end}")
                 logger.info("Waiting 60 seconds before continuing...")
                 time.sleep(60)
-                continue
+                klines = fetch_klines(w_start, w_end, symbol, interval)
             
             if not klines:
                 logger.info("No data returned, moving to next time range")
@@ -218,43 +434,54 @@ def main():
                     logger.error(f"No data for {max_empty_intervals} consecutive intervals.")
                     break
                 
-                current_start = current_end + 1
+                current_start = w_end + 1
                 continue
             
             empty_intervals = 0
             
-            batch = []
-            for k in klines:
-                timestamp = k[0]
-                close_price = k[4]
-                batch.append([timestamp, close_price])
+            # Неполный ответ (< 1000 свечей при полноразмерном окне) —
+            # внутри окна пробел в данных; окна не пересекаются, поэтому
+            # остаток пропускается сам собой, без дополнительных запросов
+            if len(klines) < 1000 and w_end - w_start + 1 == window_ms:
+                logger.debug("Partial window %s-%s: %d candles, gap skipped",
+                             w_start, w_end, len(klines))
             
-            all_data.extend(batch)
-            request_count += 1
-            last_successful_timestamp = current_start
+            # Цена закрытия приходит строкой — вся пачка конвертируется
+            # одним C-циклом np.fromiter в типизированные массивы
+            # (count заранее задает размер, без промежуточного списка)
+            times = np.fromiter((k[0] for k in klines), dtype=np.int64, count=len(klines))
+            closes = np.fromiter((k[4] for k in klines), dtype=np.float64, count=len(klines))
             
-            last_timestamp = klines[-1][0]
-            current_start = last_timestamp + interval_ms  # Переходим к следующей свече
+            if first_ts is None:
+                first_ts = int(times[0])
+            last_ts = int(times[-1])
+            total_records += len(times)
+            # Умерший поток записи данные уже не сохранит — останавливаем
+            # загрузку с исходной причиной вместо тихой потери пачек
+            if writer_failure:
+                raise RuntimeError("Writer thread failed, stopping download") from writer_failure[0]
+            write_queue.put((times, closes))
+            request_count += 1
+            last_successful_timestamp = w_start
+            current_start = w_end + 1  # Окно обработано полностью
             
             if request_count % 50 == 0:
-                save_progress(all_data, output_file)
-                
-                first_ts = all_data[0][0]
-                last_ts = all_data[-1][0]
-                logger.info(f"Progress: {len(all_data)} records | "
+                logger.info(f"Progress: {total_records} records | "
                             f"From {datetime.fromtimestamp(first_ts/1000)} to "
                             f"{datetime.fromtimestamp(last_ts/1000)}")
-            
-            # Задержка для соблюдения лимитов API
-            time.sleep(0.2)
     
     except KeyboardInterrupt:
         logger.info("Download interrupted by user")
     except Exception as e:
         logger.exception("Fatal error during download:")
     finally:
-        save_progress(all_data, output_file)
-        logger.info(f"Final save: {len(all_data)} records")
+        pool.shutdown(wait=False, cancel_futures=True)
+        # Сигнал завершения: дожидаемся, пока поток записи опустошит
+        # очередь, и только потом закрываем файл
+        write_queue.put(None)
+        writer.join()
+        fout.close()
+        logger.info(f"Final save: {total_records} records")
         
         if current_start >= end_time:
             logger.info("Download completed successfully")